@@ -316,14 +316,14 @@ def add_generic_args(parser, root_dir) -> None:
     parser.add_argument(
         "--fp16",
         action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        help="Whether to use 16-bit (mixed) precision instead of 32-bit. Native amp on PyTorch>=1.6, apex otherwise",
     )
 
     parser.add_argument(
         "--fp16_opt_level",
         type=str,
         default="O2",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
+        help="For fp16 with apex: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
         "See details at https://nvidia.github.io/apex/amp.html",
     )
     parser.add_argument("--n_tpu_cores", dest="tpu_cores", type=int)
@@ -375,8 +375,10 @@ def generic_train(
 
     train_params = {}
 
-    # TODO: remove with PyTorch 1.6 since pl uses native amp
     if args.fp16:
+        # pl defaults to native amp (torch.cuda.amp.autocast + GradScaler) on PyTorch>=1.6, which wraps
+        # training_step and validation_step, so frozen teachers and generate() also run in fp16.
+        # amp_level is only read by the apex backend.
         train_params["precision"] = 16
         train_params["amp_level"] = args.fp16_opt_level
 
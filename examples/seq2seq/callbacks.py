@@ -1,4 +1,6 @@
+import copy
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -20,6 +22,23 @@ logger = logging.getLogger(__name__)
 
 
 class Seq2SeqLoggingCallback(pl.Callback):
+    def __init__(self):
+        super().__init__()
+        self.io_pool = None  # created lazily, thread pools can't be pickled
+        self.pending_save = None
+
+    def save_metrics_in_background(self, pl_module):
+        """Write a snapshot of pl_module.metrics from a worker thread, so training resumes without waiting on disk."""
+        if self.io_pool is None:
+            self.io_pool = ThreadPoolExecutor(max_workers=1)  # one worker, so saves land in order
+        metrics = copy.deepcopy(pl_module.metrics)
+        self.pending_save = self.io_pool.submit(save_json, metrics, pl_module.metrics_save_path)
+
+    def wait_for_pending_save(self):
+        if self.pending_save is not None:
+            self.pending_save.result()  # re-raises errors from the worker thread
+            self.pending_save = None
+
     def on_batch_end(self, trainer, pl_module):
         lrs = {f"lr_group_{i}": param["lr"] for i, param in enumerate(pl_module.trainer.optimizers[0].param_groups)}
         pl_module.logger.log_metrics(lrs)
@@ -43,22 +62,22 @@ class Seq2SeqLoggingCallback(pl.Callback):
             generations_file = od / f"{type_path}_generations/{trainer.global_step:05d}.txt"
             results_file.parent.mkdir(exist_ok=True)
             generations_file.parent.mkdir(exist_ok=True)
+        lines = []
+        for key in sorted(metrics):
+            if key in ["log", "progress_bar", "preds"]:
+                continue
+            val = metrics[key]
+            if isinstance(val, torch.Tensor):
+                val = val.item()
+            lines.append(f"{key}: {val:.6f}\n")
         with open(results_file, "a+") as writer:
-            for key in sorted(metrics):
-                if key in ["log", "progress_bar", "preds"]:
-                    continue
-                val = metrics[key]
-                if isinstance(val, torch.Tensor):
-                    val = val.item()
-                msg = f"{key}: {val:.6f}\n"
-                writer.write(msg)
+            writer.write("".join(lines))
 
         if not save_generations:
             return
 
         if "preds" in metrics:
-            content = "\n".join(metrics["preds"])
-            generations_file.open("w+").write(content)
+            generations_file.write_text("\n".join(metrics["preds"]))
 
     @rank_zero_only
     def on_train_start(self, trainer, pl_module):
@@ -73,15 +92,20 @@ class Seq2SeqLoggingCallback(pl.Callback):
 
     @rank_zero_only
     def on_test_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule):
+        self.wait_for_pending_save()  # don't let an older snapshot overwrite the test metrics
         save_json(pl_module.metrics, pl_module.metrics_save_path)
         return self._write_logs(trainer, pl_module, "test")
 
     @rank_zero_only
     def on_validation_end(self, trainer: pl.Trainer, pl_module):
-        save_json(pl_module.metrics, pl_module.metrics_save_path)
+        self.save_metrics_in_background(pl_module)
         # Uncommenting this will save val generations
         # return self._write_logs(trainer, pl_module, "valid")
 
+    @rank_zero_only
+    def on_train_end(self, trainer, pl_module):
+        self.wait_for_pending_save()
+
 
 def get_checkpoint_callback(output_dir, metric, save_top_k=1, lower_is_better=False):
     """Saves the best model by validation ROUGE2 score."""
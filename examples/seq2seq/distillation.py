@@ -2,22 +2,38 @@
 
 import argparse
 import gc
+import math
 import os
 import sys
+from collections import defaultdict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 
 import pytorch_lightning as pl
 import torch
+from packaging import version
 from torch import nn
 from torch.nn import functional as F
 
 from finetune import SummarizationModule, TranslationModule
 from finetune import main as ft_main
 from make_student import create_student_by_copying_alternating_layers, get_layers_to_supervise
-from transformers import AutoModelForSeq2SeqLM, MBartTokenizer, T5ForConditionalGeneration
+from transformers import (
+    AutoModelForSeq2SeqLM,
+    BartForConditionalGeneration,
+    MBartTokenizer,
+    T5ForConditionalGeneration,
+)
 from transformers.models.bart.modeling_bart import shift_tokens_right
-from utils import calculate_bleu, check_output_dir, freeze_params, label_smoothed_nll_loss, use_task_specific_params
+from utils import (
+    PrecomputedTeacherDataset,
+    calculate_bleu,
+    check_output_dir,
+    freeze_params,
+    label_smoothed_nll_loss,
+    use_task_specific_params,
+)
 
 
 # need the parent dir module
@@ -25,6 +41,154 @@ sys.path.insert(2, str(Path(__file__).resolve().parents[1]))
 from lightning_base import generic_train  # noqa
 
 
+# kl_div accepts log-probability targets and torch.cuda.amp (native amp) exists from torch 1.6
+_kl_div_log_target_available = version.parse(torch.__version__) >= version.parse("1.6")
+_native_amp_available = version.parse(torch.__version__) >= version.parse("1.6")
+# T5 and Pegasus overflow in pure fp16, because their residual stream is only safe in fp32. Under autocast with fp32
+# weights it stays fp32, so only the teachers below get their weights cast to fp16 with --fp16
+_fp16_weight_teacher_types = ("bart", "mbart", "marian")
+
+
+class CUDAGraphTeacher:
+    """Replays the frozen teacher's decoder and lm head from CUDA graphs captured per bucket of input shapes.
+
+    Collate functions pad every batch to its own longest example, so batches are padded further, up to a multiple of
+    ``src_multiple`` source and ``tgt_multiple`` target tokens and to a power of two examples, for shapes to repeat.
+    The outputs are sliced back to the real batch. A graph is captured once its bucket was seen ``min_count`` times,
+    until ``max_graphs`` graphs exist, and other buckets run eagerly. Each call copies the batch into the static input
+    buffers of its bucket and replays the graph, so the kernel launches of a whole forward pass become a single one.
+
+    ``BartModel.forward`` can't be captured: it syncs on ``padding_mask.any()`` and copies a causal mask built on
+    the cpu. So the decoder is called directly, with masks built on the device, which limits this to the Bart family
+    (Bart, mBART, Marian, Pegasus). T5 builds its relative position buckets on the cpu for the same reason.
+
+    All graphs share one memory pool, so only their static inputs and outputs are kept per graph. The returned
+    outputs are views of those static buffers and are overwritten by the next call. Inputs must not require grad,
+    because a graph cannot record the autograd tape.
+    """
+
+    def __init__(
+        self,
+        teacher: nn.Module,
+        pad_token_id: int,
+        max_source_length: int,
+        max_target_length: int,
+        src_multiple: int = 128,
+        tgt_multiple: int = 16,
+        max_graphs: int = 4,
+        min_count: int = 2,
+    ):
+        if not hasattr(torch.cuda, "graph"):
+            raise ImportError("CUDA graphs require PyTorch>=1.10")
+        if not isinstance(teacher, BartForConditionalGeneration):
+            raise ValueError(f"--cuda_graph_teacher only supports Bart family teachers, got {type(teacher).__name__}")
+        self.teacher = teacher
+        self.pad_token_id = pad_token_id
+        self.max_source_length, self.max_target_length = max_source_length, max_target_length
+        self.src_multiple, self.tgt_multiple = src_multiple, tgt_multiple
+        self.max_graphs = max_graphs
+        self.min_count = min_count
+        self.graphs = {}
+        self.bucket_counts = defaultdict(int)
+        self.pool = None  # created with the first graph
+
+    def causal_mask(self, tgt_len: int, device) -> torch.Tensor:
+        dtype = self.teacher.model.shared.weight.dtype  # like _prepare_bart_decoder_inputs
+        return torch.full((tgt_len, tgt_len), float("-inf"), dtype=dtype, device=device).triu(1)
+
+    def forward(self, attention_mask, encoder_hidden_states, decoder_input_ids, causal_mask, output_hidden_states):
+        """Teacher forward pass from the encoder outputs, without host syncs or host to device copies."""
+        decoder_padding_mask = decoder_input_ids.eq(self.pad_token_id)
+        if decoder_padding_mask.shape[1] > 1:
+            decoder_padding_mask[:, 0] = decoder_padding_mask[:, 1]  # never mask the leading token, as Bart does
+        base_model = self.teacher.model
+        decoder_outputs = base_model.decoder(
+            decoder_input_ids,
+            encoder_hidden_states,
+            attention_mask,
+            decoder_padding_mask,
+            decoder_causal_mask=causal_mask,
+            output_hidden_states=output_hidden_states,
+            return_dict=True,
+        )
+        logits = F.linear(
+            decoder_outputs.last_hidden_state, base_model.shared.weight, bias=self.teacher.final_logits_bias
+        )
+        return {"logits": logits, "decoder_hidden_states": decoder_outputs.hidden_states}
+
+    @staticmethod
+    def round_up(length: int, multiple: int, max_length: int) -> int:
+        return min(math.ceil(length / multiple) * multiple, max(length, max_length))
+
+    def bucket(self, attention_mask, decoder_input_ids) -> Tuple[int, int, int]:
+        bs, src_len = attention_mask.shape
+        tgt_len = decoder_input_ids.shape[1]
+        return (
+            1 << (bs - 1).bit_length(),
+            self.round_up(src_len, self.src_multiple, self.max_source_length),
+            self.round_up(tgt_len, self.tgt_multiple, self.max_target_length),
+        )
+
+    def capture(self, bucket, inputs: tuple, output_hidden_states: bool):
+        bs, src_len, tgt_len = bucket
+        attention_mask, encoder_hidden_states, decoder_input_ids = inputs
+        static_inputs = [
+            attention_mask.new_empty((bs, src_len)),
+            encoder_hidden_states.new_empty((bs, src_len, encoder_hidden_states.shape[-1])),
+            decoder_input_ids.new_empty((bs, tgt_len)),
+        ]
+        self.copy_inputs(static_inputs, inputs)
+        causal_mask = self.causal_mask(tgt_len, decoder_input_ids.device)
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream), torch.no_grad():
+            for _ in range(3):  # warm up cublas workspaces and the caching allocator before capture
+                self.forward(*static_inputs, causal_mask, output_hidden_states)
+        torch.cuda.current_stream().wait_stream(side_stream)
+        if self.pool is None:
+            self.pool = torch.cuda.graph_pool_handle()
+        graph = torch.cuda.CUDAGraph()
+        # sharing the pool is safe because graphs are replayed one at a time and their outputs are consumed in between
+        with torch.cuda.graph(graph, pool=self.pool), torch.no_grad():
+            static_outputs = self.forward(*static_inputs, causal_mask, output_hidden_states)
+        return graph, static_inputs, static_outputs
+
+    def copy_inputs(self, static_inputs, inputs):
+        """Copy the batch into the top left corner of the static buffers and pad the rest."""
+        static_mask, static_hidden, static_decoder_input_ids = static_inputs
+        attention_mask, encoder_hidden_states, decoder_input_ids = inputs
+        bs, src_len = attention_mask.shape
+        static_mask.zero_()
+        static_hidden.zero_()
+        static_decoder_input_ids.fill_(self.pad_token_id)
+        # padding examples attend to one real token, so that fully masked attention doesn't produce nan
+        static_mask[bs:, 0] = 1
+        static_decoder_input_ids[bs:, 0] = decoder_input_ids[0, 0]
+        static_mask[:bs, :src_len].copy_(attention_mask)
+        static_hidden[:bs, :src_len].copy_(encoder_hidden_states)
+        static_decoder_input_ids[:bs, : decoder_input_ids.shape[1]].copy_(decoder_input_ids)
+
+    def __call__(self, attention_mask, encoder_hidden_states, decoder_input_ids, output_hidden_states):
+        inputs = (attention_mask, encoder_hidden_states, decoder_input_ids)
+        assert not any(x.requires_grad for x in inputs), "CUDAGraphTeacher inputs must not require grad"
+        bucket = self.bucket(attention_mask, decoder_input_ids)
+        key = bucket + (output_hidden_states, self.teacher.training, torch.is_autocast_enabled())
+        if key not in self.graphs:
+            self.bucket_counts[key] += 1
+            if len(self.graphs) >= self.max_graphs or self.bucket_counts[key] < self.min_count:
+                causal_mask = self.causal_mask(decoder_input_ids.shape[1], decoder_input_ids.device)
+                return self.forward(*inputs, causal_mask, output_hidden_states)
+            self.graphs[key] = self.capture(bucket, inputs, output_hidden_states)
+        graph, static_inputs, static_outputs = self.graphs[key]
+        self.copy_inputs(static_inputs, inputs)
+        graph.replay()
+        bs, tgt_len = decoder_input_ids.shape
+        outputs = {"logits": static_outputs["logits"][:bs, :tgt_len]}
+        if output_hidden_states:
+            outputs["decoder_hidden_states"] = [h[:bs, :tgt_len] for h in static_outputs["decoder_hidden_states"]]
+        return outputs
+
+
 class SummarizationDistiller(SummarizationModule):
     """Supports T5, Bart, Pegasus and other models that inherit from Bart."""
 
@@ -71,15 +235,26 @@ class SummarizationDistiller(SummarizationModule):
         self.different_base_models = not (hparams.student is None or hparams.teacher == hparams.student)
         self.do_calc_hidden_loss = (not self.different_base_models) and hparams.alpha_hid > 0
         self.different_encoder = self.different_base_models or (student_encoder_layers != teacher_encoder_layers)
-        # self.different_encoder determines whether we need to run the teacher encoder
-        self.teacher = teacher
-        freeze_params(self.teacher)
+        # The teacher decoder attends to the student's encoder states unless the base models differ, so the teacher
+        # encoder only has to run for those or to supervise the hidden states of a student encoder with fewer layers.
+        self.run_teacher_encoder = self.different_base_models or (self.different_encoder and self.do_calc_hidden_loss)
+        self.fp16_teacher = hparams.fp16 and _native_amp_available
+        if hparams.precomputed_teacher is not None:
+            if self.do_calc_hidden_loss:
+                raise ValueError("--precomputed_teacher only stores logits, it can't be combined with --alpha_hid")
+            self.teacher = None  # the saved top-k logits replace the teacher forward pass, so free its memory
+            del teacher
+        else:
+            self.teacher = teacher
+            freeze_params(self.teacher)
+            if self.fp16_teacher and teacher.config.model_type in _fp16_weight_teacher_types:
+                self.teacher.half()  # halves the teacher's memory, its fp16 matmuls run under autocast anyway
 
-        if not self.different_encoder:  # To save RAM, delete teacher encoder and freeze student encoder.
-            try:
-                del self.teacher.model.encoder
-            except AttributeError:  # T5
-                del self.teacher.encoder
+            if not self.run_teacher_encoder:  # To save RAM, delete teacher encoder and freeze student encoder.
+                try:
+                    del self.teacher.model.encoder
+                except AttributeError:  # T5
+                    del self.teacher.encoder
 
         if e_layer_ids is None:
             e_layer_ids = list(range(student_encoder_layers))
@@ -103,7 +278,27 @@ class SummarizationDistiller(SummarizationModule):
             self.e_matches = None
             self.d_matches = None
 
-        self.ce_loss_fct = nn.KLDivLoss(reduction="batchmean")
+        use_graphs = hparams.cuda_graph_teacher and self.teacher is not None
+        self.teacher_device = None
+        if hparams.teacher_device is not None and self.teacher is not None:
+            if hparams.gpus > 1 or use_graphs:
+                raise ValueError("--teacher_device can't be combined with --gpus > 1 or --cuda_graph_teacher")
+            self.teacher_device = torch.device(hparams.teacher_device)
+        # not an nn.Module, so the graphs' static buffers stay out of the module tree and checkpoints
+        self.teacher_graphs = None
+        if use_graphs:
+            self.teacher_graphs = CUDAGraphTeacher(
+                self.teacher,
+                self.tokenizer.pad_token_id,
+                max_source_length=self.hparams.max_source_length,
+                max_target_length=max(self.target_lens.values()),
+            )
+        # teacher log-probs are passed as the target, so kl_div doesn't have to take the log of the teacher probs again
+        self.log_target = _kl_div_log_target_available
+        if self.log_target:
+            self.ce_loss_fct = nn.KLDivLoss(reduction="batchmean", log_target=True)
+        else:
+            self.ce_loss_fct = nn.KLDivLoss(reduction="batchmean")
         self.temperature = 2.0
         self.alpha_mlm = hparams.alpha_mlm
         self.alpha_ce = hparams.alpha_ce
@@ -111,20 +306,52 @@ class SummarizationDistiller(SummarizationModule):
         gc.collect()
         torch.cuda.empty_cache()
 
+    def place_teacher(self):
+        """Lightning moves the whole module to the student's device, so move the teacher (back) to --teacher_device."""
+        if self.teacher_device is not None and self.teacher.device != self.teacher_device:
+            self.teacher.to(self.teacher_device)
+            torch.cuda.empty_cache()  # return the teacher's memory on the student's gpu
+
+    # lightning moves the module to the student's gpu when it sets up the accelerator, before training and testing
+    def on_fit_start(self):
+        self.place_teacher()
+
+    def on_train_start(self):
+        self.place_teacher()
+
+    def on_test_start(self):
+        self.place_teacher()
+
+    @contextmanager
+    def teacher_autocast(self):
+        """With --fp16 the teacher runs under autocast, which also casts the student's fp32 encoder states to match."""
+        if not self.fp16_teacher:
+            yield
+            return
+        with torch.cuda.amp.autocast():
+            yield
+
+    def train(self, mode: bool = True):
+        """Keep the frozen teacher in eval mode, lightning calls model.train() at the start of every epoch."""
+        super().train(mode)
+        if self.teacher is not None:
+            self.teacher.eval()
+        return self
+
     def calc_ce_loss(self, mask, s_logits, t_logits):
         """Copy pasted from distillbert (transformers/examples/distillation/)"""
         # mask has False at padding_idx
-        sel_mask = mask[:, :, None].expand_as(s_logits)
         vocab_size = s_logits.size(-1)
-        s_logits_slct = torch.masked_select(s_logits, sel_mask)  # (bs * seq_length * voc_size) modulo the 1s in mask
-        t_logits_slct = torch.masked_select(t_logits, sel_mask)  # (bs * seq_length * voc_size) modulo the 1s in mask
-        s_logits_slct = s_logits_slct.view(-1, vocab_size)  # (bs * seq_length, voc_size) modulo the 1s in mask
-        t_logits_slct = t_logits_slct.view(-1, vocab_size)  # (bs * seq_length, voc_size) modulo the 1s in mask
+        # select whole rows of the flattened logits instead of masked_select-ing a (bs, seq_length, voc_size) mask
+        pos_idx = mask.reshape(-1).nonzero(as_tuple=True)[0]  # (n_tokens,) indices of non-pad positions
+        s_logits_slct = s_logits.reshape(-1, vocab_size).index_select(0, pos_idx)  # (n_tokens, voc_size)
+        t_logits_slct = t_logits.reshape(-1, vocab_size).index_select(0, pos_idx).type_as(s_logits_slct)
         assert t_logits_slct.size() == s_logits_slct.size()
+        target_fn = F.log_softmax if self.log_target else F.softmax
         loss_ce = (
             self.ce_loss_fct(
                 F.log_softmax(s_logits_slct / self.temperature, dim=-1),
-                F.softmax(t_logits_slct / self.temperature, dim=-1),
+                target_fn(t_logits_slct / self.temperature, dim=-1),
             )
             * (self.temperature) ** 2
         )
@@ -136,6 +363,60 @@ class SummarizationDistiller(SummarizationModule):
         add_distill_args(parser)
         return parser
 
+    def get_dataset(self, type_path):
+        dataset = super().get_dataset(type_path)
+        teacher_dir = self.hparams.precomputed_teacher
+        if teacher_dir is not None and (
+            type_path == "train" or PrecomputedTeacherDataset.paths(teacher_dir, type_path)[0].exists()
+        ):
+            dataset = PrecomputedTeacherDataset(dataset, teacher_dir, type_path=type_path)
+        return dataset
+
+    def precomputed_teacher_logits(self, batch: dict, lm_logits: torch.Tensor) -> torch.Tensor:
+        """Scatter the saved top-k teacher logits into a full (bs, seq_len, vocab_size) tensor."""
+        # fill with a finite value: kl_div would compute 0 * -inf = nan for the tokens outside the top-k
+        t_logits = torch.full_like(lm_logits, torch.finfo(lm_logits.dtype).min)
+        return t_logits.scatter_(-1, batch["teacher_topk_indices"], batch["teacher_topk_values"].to(lm_logits))
+
+    def to_teacher(self, x: torch.Tensor) -> torch.Tensor:
+        """Copy x to the teacher's device, a no-op without --teacher_device."""
+        return x.to(self.teacher.device, non_blocking=True)
+
+    def teacher_forward(self, input_ids, src_mask, decoder_input_ids, encoder_hidden_states=None):
+        """Queue the teacher's forward pass on its device. Inputs must already be on the teacher's device.
+
+        encoder_hidden_states are the student's, and are ignored when the base models differ, in which case the
+        teacher runs its own encoder. Returns the teacher outputs and, for intermediate supervision of the encoder,
+        the teacher encoder's hidden states.
+        """
+        teacher_encoder_hidden_states = None
+        with self.teacher_autocast():
+            if self.run_teacher_encoder:
+                all_teacher_encoder_outputs = self.teacher.get_encoder()(
+                    input_ids,
+                    attention_mask=src_mask,
+                    output_hidden_states=self.do_calc_hidden_loss,
+                )
+                if self.different_base_models:
+                    encoder_hidden_states = all_teacher_encoder_outputs["last_hidden_state"]
+                elif self.do_calc_hidden_loss:
+                    teacher_encoder_hidden_states = all_teacher_encoder_outputs["hidden_states"]
+
+            if self.teacher_graphs is not None and not encoder_hidden_states.requires_grad:
+                teacher_outputs = self.teacher_graphs(
+                    src_mask, encoder_hidden_states, decoder_input_ids, self.do_calc_hidden_loss
+                )
+            else:  # the student encoder is trained through the teacher's cross attention, which a graph can't record
+                teacher_outputs = self.teacher(
+                    input_ids,
+                    attention_mask=src_mask,
+                    encoder_outputs=(encoder_hidden_states,),
+                    decoder_input_ids=decoder_input_ids,
+                    output_hidden_states=self.do_calc_hidden_loss,
+                    use_cache=False,  # since we are not passing labels, never let this default to True
+                )
+        return teacher_outputs, teacher_encoder_hidden_states
+
     def _step(self, batch: dict) -> tuple:
         """Compute the loss for a batch"""
         pad_token_id = self.tokenizer.pad_token_id
@@ -145,10 +426,33 @@ class SummarizationDistiller(SummarizationModule):
         else:
             decoder_input_ids = shift_tokens_right(labels, pad_token_id)
 
+        # Kernels and copies are queued asynchronously, so with --teacher_device the teacher runs on its gpu while the
+        # student runs on its own. Each teacher step is therefore queued as soon as its inputs are: the batch is copied
+        # before any student work, a teacher with a different base model runs before the student, and otherwise the
+        # teacher decoder runs between the student encoder and the student decoder.
+        teacher_outputs, teacher_encoder_hidden_states = None, None
+        if self.teacher is not None:
+            self.place_teacher()  # normally already done by the on_*_start hooks, cheap to check again
+            teacher_inputs = [self.to_teacher(x) for x in (input_ids, src_mask, decoder_input_ids)]
+            if self.different_base_models:
+                teacher_outputs, teacher_encoder_hidden_states = self.teacher_forward(*teacher_inputs)
+
+        student_encoder_outputs = self.model.get_encoder()(
+            input_ids,
+            attention_mask=src_mask,
+            output_hidden_states=self.do_calc_hidden_loss,
+            return_dict=True,
+        )
+        if self.teacher is not None and not self.different_base_models:
+            teacher_outputs, teacher_encoder_hidden_states = self.teacher_forward(
+                *teacher_inputs, self.to_teacher(student_encoder_outputs["last_hidden_state"])
+            )
+
         # noinspection PyCallingNonCallable
         student_outputs = self(
             input_ids,
             attention_mask=src_mask,
+            encoder_outputs=student_encoder_outputs,
             decoder_input_ids=decoder_input_ids,
             output_hidden_states=self.do_calc_hidden_loss,
             output_attentions=False,
@@ -160,8 +464,7 @@ class SummarizationDistiller(SummarizationModule):
         assert lm_logits.shape[-1] == self.model.config.vocab_size
         if self.hparams.label_smoothing == 0:
             # Same behavior as modeling_bart.py, besides ignoring pad_token_id
-            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=pad_token_id)
-            student_lm_loss = loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), labels.view(-1))
+            student_lm_loss = self.lm_loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), labels.view(-1))
         else:
             lprobs = F.log_softmax(lm_logits, dim=-1)
             student_lm_loss, _ = label_smoothed_nll_loss(
@@ -171,42 +474,34 @@ class SummarizationDistiller(SummarizationModule):
         def zero_tensor():
             return torch.tensor(0.0).type_as(student_lm_loss)
 
-        teacher_enc_outputs = student_outputs[
-            "encoder_last_hidden_state"
-        ]  # use this unless self.different_base_models
+        dec_mask = decoder_input_ids.ne(pad_token_id)
+        if self.teacher is None:  # --precomputed_teacher
+            if "teacher_topk_values" in batch:
+                loss_ce = self.calc_ce_loss(dec_mask, lm_logits, self.precomputed_teacher_logits(batch, lm_logits))
+            else:  # no logits were saved for this split
+                loss_ce = zero_tensor()
+            blended_loss = self.alpha_ce * loss_ce + self.alpha_mlm * student_lm_loss
+            return blended_loss, loss_ce, student_lm_loss, zero_tensor(), zero_tensor()
+
+        def to_student(states):
+            return [x.to(lm_logits.device, non_blocking=True) for x in states]
+
         hid_loss_enc, hid_loss_dec = zero_tensor(), zero_tensor()
-        if self.different_encoder:  # compute encoder hidden state loss
-            all_teacher_encoder_outputs = self.teacher.get_encoder()(
-                input_ids,
-                attention_mask=src_mask,
-                output_hidden_states=self.do_calc_hidden_loss,
+        if teacher_encoder_hidden_states is not None:  # compute encoder hidden state loss
+            hid_loss_enc = self.calc_hidden_loss(
+                src_mask,
+                student_encoder_outputs["hidden_states"],
+                to_student(teacher_encoder_hidden_states),
+                self.e_matches,
+                normalize_hidden=self.hparams.normalize_hidden,
             )
-            if self.different_base_models:
-                teacher_enc_outputs = all_teacher_encoder_outputs["last_hidden_state"]
-            elif self.do_calc_hidden_loss:
-                hid_loss_enc = self.calc_hidden_loss(
-                    src_mask,
-                    student_outputs["encoder_hidden_states"],
-                    all_teacher_encoder_outputs["hidden_states"],
-                    self.e_matches,
-                    normalize_hidden=self.hparams.normalize_hidden,
-                )
-
-        teacher_outputs = self.teacher(
-            input_ids,
-            attention_mask=src_mask,
-            encoder_outputs=(teacher_enc_outputs,),
-            decoder_input_ids=decoder_input_ids,
-            output_hidden_states=self.do_calc_hidden_loss,
-            use_cache=False,  # since we are not passing labels, never let this default to True
-        )
-        dec_mask = decoder_input_ids.ne(pad_token_id)
-        loss_ce = self.calc_ce_loss(dec_mask, lm_logits, teacher_outputs["logits"])
+        (teacher_logits,) = to_student([teacher_outputs["logits"]])
+        loss_ce = self.calc_ce_loss(dec_mask, lm_logits, teacher_logits)
         if self.do_calc_hidden_loss:  # Intermediate supervision of decoder hidden states
             hid_loss_dec = self.calc_hidden_loss(
                 dec_mask,
                 student_outputs["decoder_hidden_states"],
-                teacher_outputs["decoder_hidden_states"],
+                to_student(teacher_outputs["decoder_hidden_states"]),
                 self.d_matches,
                 normalize_hidden=self.hparams.normalize_hidden,
             )
@@ -227,7 +522,7 @@ class SummarizationDistiller(SummarizationModule):
         mask = attention_mask.to(hidden_states[0])
         valid_count = mask.sum() * hidden_states[0].size(-1)
         student_states = torch.stack([hidden_states[i] for i in range(len(matches))])
-        teacher_states = torch.stack([hidden_states_T[j] for j in matches])
+        teacher_states = torch.stack([hidden_states_T[j] for j in matches]).type_as(student_states)  # fp16 teacher
         assert student_states.shape == teacher_states.shape, f"{student_states.shape} != {teacher_states.shape}"
         if normalize_hidden:
             student_states = F.layer_norm(student_states, student_states.shape[1:])
@@ -254,6 +549,29 @@ def add_distill_args(parser):
     parser.add_argument("--length_penalty", type=float, default=-1)
     parser.add_argument("--supervise_forward", action="store_true", default=False)
     parser.add_argument("--normalize_hidden", action="store_true", default=False)
+    parser.add_argument(
+        "--cuda_graph_teacher",
+        action="store_true",
+        default=False,
+        help="Replay the teacher's decoder from CUDA graphs captured per batch shape. Requires PyTorch>=1.10 and a "
+        "Bart family teacher (Bart, mBART, Marian, Pegasus). Only used when the encoder states passed to the teacher "
+        "do not require grad, e.g. with --freeze_encoder.",
+    )
+    parser.add_argument(
+        "--teacher_device",
+        type=str,
+        default=None,
+        help="Run the teacher on another device than the student, e.g. cuda:1 on a 2 gpu node with --gpus 1. "
+        "A teacher with a different base model then runs in parallel with the whole student forward pass, otherwise "
+        "the teacher decoder runs in parallel with the student decoder.",
+    )
+    parser.add_argument(
+        "--precomputed_teacher",
+        type=str,
+        default=None,
+        help="Directory with the teacher top-k logits saved by precompute_teacher_logits.py. The teacher forward pass "
+        "is skipped and the teacher is freed after initializing the student. Splits without saved logits report ce_loss=0.",
+    )
 
 
 class TranslationDistiller(SummarizationDistiller):
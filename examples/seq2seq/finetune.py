@@ -7,12 +7,14 @@ import os
 import sys
 import time
 from collections import defaultdict
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Dict, List, Tuple
 
 import numpy as np
 import pytorch_lightning as pl
 import torch
+from packaging import version
 from torch.utils.data import DataLoader
 
 from callbacks import Seq2SeqLoggingCallback, get_checkpoint_callback, get_early_stopping_callback
@@ -20,8 +22,11 @@ from transformers import MBartTokenizer, T5ForConditionalGeneration
 from transformers.models.bart.modeling_bart import shift_tokens_right
 from utils import (
     ROUGE_KEYS,
+    CachedSeq2SeqDataset,
+    CUDAPrefetcher,
     LegacySeq2SeqDataset,
     Seq2SeqDataset,
+    TracedEncoder,
     assert_all_frozen,
     calculate_bleu,
     calculate_rouge,
@@ -46,6 +51,9 @@ from lightning_base import BaseTransformer, add_generic_args, generic_train  # n
 
 logger = logging.getLogger(__name__)
 
+# DataLoader only accepts prefetch_factor and persistent_workers from torch 1.7
+_dataloader_prefetch_available = version.parse(torch.__version__) >= version.parse("1.7")
+
 
 class SummarizationModule(BaseTransformer):
     mode = "summarization"
@@ -104,16 +112,31 @@ class SummarizationModule(BaseTransformer):
         if self.model.config.decoder_start_token_id is None and isinstance(self.tokenizer, MBartTokenizer):
             self.decoder_start_token_id = self.tokenizer.lang_code_to_id[hparams.tgt_lang]
             self.model.config.decoder_start_token_id = self.decoder_start_token_id
-        self.dataset_class = (
-            Seq2SeqDataset if hasattr(self.tokenizer, "prepare_seq2seq_batch") else LegacySeq2SeqDataset
-        )
+        if not self.hparams.no_cache:
+            self.dataset_class = CachedSeq2SeqDataset
+            cache_dir = self.hparams.tokenized_cache_dir
+            self.dataset_kwargs["cache_dir"] = self.output_dir / "tokenized_cache" if cache_dir is None else cache_dir
+        elif hasattr(self.tokenizer, "prepare_seq2seq_batch"):
+            self.dataset_class = Seq2SeqDataset
+        else:
+            self.dataset_class = LegacySeq2SeqDataset
         self.already_saved_batch = False
+        # built once instead of every step. Labels are used as is, pad positions are ignored instead of set to -100
+        self.lm_loss_fct = torch.nn.CrossEntropyLoss(ignore_index=self.tokenizer.pad_token_id)
         self.eval_beams = self.model.config.num_beams if self.hparams.eval_beams is None else self.hparams.eval_beams
         if self.hparams.eval_max_gen_length is not None:
             self.eval_max_length = self.hparams.eval_max_gen_length
         else:
             self.eval_max_length = self.model.config.max_length
         self.val_metric = self.default_val_metric if self.hparams.val_metric is None else self.hparams.val_metric
+        self.compute_val_loss = self.hparams.val_compute_loss or self.val_metric == "loss"
+        if self.hparams.jit_encoder and not hasattr(getattr(self.model, "model", None), "encoder"):
+            raise ValueError(f"--jit_encoder only supports models with a model.model.encoder, got {self.model_type}")
+        if self.hparams.jit_encoder and self.hparams.fp16:
+            # tracing freezes the encoder layers' data dependent clamp of fp16 overflows to the first batch's branch
+            raise ValueError("--jit_encoder can't be combined with --fp16")
+        # kept in a dict so that they are not registered as submodules and saved in checkpoints
+        self.traced_encoders: Dict[torch.device, TracedEncoder] = {}
 
     def save_readable_batch(self, batch: Dict[str, torch.Tensor]) -> Dict[str, List[str]]:
         """A debugging utility"""
@@ -151,10 +174,8 @@ class SummarizationModule(BaseTransformer):
         lm_logits = outputs["logits"]
         if self.hparams.label_smoothing == 0:
             # Same behavior as modeling_bart.py, besides ignoring pad_token_id
-            ce_loss_fct = torch.nn.CrossEntropyLoss(ignore_index=pad_token_id)
-
             assert lm_logits.shape[-1] == self.vocab_size
-            loss = ce_loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), tgt_ids.view(-1))
+            loss = self.lm_loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), tgt_ids.view(-1))
         else:
             lprobs = torch.nn.functional.log_softmax(lm_logits, dim=-1)
             loss, nll_loss = label_smoothed_nll_loss(
@@ -183,48 +204,69 @@ class SummarizationModule(BaseTransformer):
 
     def validation_epoch_end(self, outputs, prefix="val") -> Dict:
         self.step_count += 1
-        losses = {k: torch.stack([x[k] for x in outputs]).mean() for k in self.loss_names}
-        loss = losses["loss"]
-        generative_metrics = {
-            k: np.array([x[k] for x in outputs]).mean() for k in self.metric_names + ["gen_time", "gen_len"]
-        }
+        losses, result = {}, {}
+        if self.compute_val_loss:  # otherwise the losses are left out of the metrics, see --val_compute_loss
+            # (n_batches, n_losses), reduced at once so that the means are copied to the cpu with a single sync
+            loss_means = torch.stack([torch.stack([x[k] for k in self.loss_names]) for x in outputs]).mean(0)
+            losses = dict(zip(self.loss_names, loss_means.tolist()))
+            result[f"{prefix}_loss"] = loss_means[self.loss_names.index("loss")]
+        generative_names = self.metric_names + ["gen_time", "gen_len"]
+        generative_means = np.array([[x[k] for k in generative_names] for x in outputs]).mean(0)
+        generative_metrics = dict(zip(generative_names, generative_means.tolist()))
         metric_val = (
             generative_metrics[self.val_metric] if self.val_metric in generative_metrics else losses[self.val_metric]
         )
-        metric_tensor: torch.FloatTensor = torch.tensor(metric_val).type_as(loss)
-        generative_metrics.update({k: v.item() for k, v in losses.items()})
+        metric_tensor: torch.FloatTensor = torch.tensor(metric_val, dtype=torch.float, device=self.device)
         losses.update(generative_metrics)
         all_metrics = {f"{prefix}_avg_{k}": x for k, x in losses.items()}
         all_metrics["step_count"] = self.step_count
         self.metrics[prefix].append(all_metrics)  # callback writes this to self.metrics_save_path
         preds = flatten_list([x["preds"] for x in outputs])
-        return {
-            "log": all_metrics,
-            "preds": preds,
-            f"{prefix}_loss": loss,
-            f"{prefix}_{self.val_metric}": metric_tensor,
-        }
+        result.update({"log": all_metrics, "preds": preds, f"{prefix}_{self.val_metric}": metric_tensor})
+        return result
 
     def calc_generative_metrics(self, preds, target) -> Dict:
         return calculate_rouge(preds, target)
 
+    @contextmanager
+    def maybe_traced_encoder(self, batch: dict):
+        """With --jit_encoder, swap in a torch.jit.trace'd encoder for the duration of the block. Not used by _step."""
+        if not self.hparams.jit_encoder:
+            yield
+            return
+        base_model = self.model.model
+        device = batch["input_ids"].device
+        if device not in self.traced_encoders:
+            with torch.no_grad():
+                self.traced_encoders[device] = TracedEncoder(
+                    base_model.encoder, batch["input_ids"], batch["attention_mask"]
+                )
+        encoder = base_model.encoder
+        base_model.encoder = self.traced_encoders[device]
+        try:
+            yield
+        finally:
+            base_model.encoder = encoder
+
     def _generative_step(self, batch: dict) -> dict:
-        t0 = time.time()
-
-        # parser.add_argument('--eval_max_gen_length', type=int, default=None, help='never generate more than n tokens')
-        generated_ids = self.model.generate(
-            batch["input_ids"],
-            attention_mask=batch["attention_mask"],
-            use_cache=True,
-            decoder_start_token_id=self.decoder_start_token_id,
-            num_beams=self.eval_beams,
-            max_length=self.eval_max_length,
-        )
-        gen_time = (time.time() - t0) / batch["input_ids"].shape[0]
+        with self.maybe_traced_encoder(batch):
+            t0 = time.time()
+
+            # parser.add_argument('--eval_max_gen_length', type=int, default=None, help='never generate more than n tokens')
+            generated_ids = self.model.generate(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                use_cache=True,
+                decoder_start_token_id=self.decoder_start_token_id,
+                num_beams=self.eval_beams,
+                max_length=self.eval_max_length,
+            )
+            gen_time = (time.time() - t0) / batch["input_ids"].shape[0]
         preds: List[str] = self.ids_to_clean_text(generated_ids)
         target: List[str] = self.ids_to_clean_text(batch["labels"])
-        loss_tensors = self._step(batch)
-        base_metrics = {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
+        base_metrics = {}
+        if self.compute_val_loss:  # the teacher-forced forward pass would only feed the logged losses
+            base_metrics.update(zip(self.loss_names, self._step(batch)))
         rouge: Dict = self.calc_generative_metrics(preds, target)
         summ_len = np.mean(lmap(len, generated_ids))
         base_metrics.update(gen_time=gen_time, gen_len=summ_len, preds=preds, target=target, **rouge)
@@ -248,6 +290,14 @@ class SummarizationModule(BaseTransformer):
         )
         return dataset
 
+    @property
+    def dataloader_kwargs(self) -> dict:
+        """Worker settings shared by all dataloaders. prefetch_factor and persistent_workers need num_workers > 0."""
+        kwargs = dict(num_workers=self.num_workers, pin_memory=True)
+        if self.num_workers > 0 and _dataloader_prefetch_available:
+            kwargs.update(prefetch_factor=self.hparams.dataloader_prefetch_factor, persistent_workers=True)
+        return kwargs
+
     def get_dataloader(self, type_path: str, batch_size: int, shuffle: bool = False) -> DataLoader:
         dataset = self.get_dataset(type_path)
 
@@ -258,8 +308,8 @@ class SummarizationModule(BaseTransformer):
                 batch_size=batch_size,
                 collate_fn=dataset.collate_fn,
                 shuffle=False,
-                num_workers=self.num_workers,
                 sampler=sampler,
+                **self.dataloader_kwargs,
             )
 
         elif self.hparams.max_tokens_per_batch is not None and type_path != "test" and type_path != "val":
@@ -271,8 +321,8 @@ class SummarizationModule(BaseTransformer):
                 batch_sampler=batch_sampler,
                 collate_fn=dataset.collate_fn,
                 # shuffle=False,
-                num_workers=self.num_workers,
                 # batch_size=None,
+                **self.dataloader_kwargs,
             )
         else:
             return DataLoader(
@@ -280,12 +330,22 @@ class SummarizationModule(BaseTransformer):
                 batch_size=batch_size,
                 collate_fn=dataset.collate_fn,
                 shuffle=shuffle,
-                num_workers=self.num_workers,
                 sampler=None,
+                **self.dataloader_kwargs,
             )
 
+    def transfer_batch_to_device(self, batch, device: torch.device):
+        """Copy the (pinned) batch with non_blocking=True so the H2D transfer can overlap with compute."""
+        if not isinstance(batch, dict):
+            return super().transfer_batch_to_device(batch, device)
+        return {k: v.to(device, non_blocking=True) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+
     def train_dataloader(self) -> DataLoader:
         dataloader = self.get_dataloader("train", batch_size=self.hparams.train_batch_size, shuffle=True)
+        if self.hparams.gpus == 1 and torch.cuda.is_available():
+            # overlap the next batch's H2D copy with the current step.
+            # Not used with ddp, where lightning needs to see a DataLoader to inject its sampler.
+            return CUDAPrefetcher(dataloader)
         return dataloader
 
     def val_dataloader(self) -> DataLoader:
@@ -328,9 +388,34 @@ class SummarizationModule(BaseTransformer):
         )
         parser.add_argument("--freeze_encoder", action="store_true")
         parser.add_argument("--freeze_embeds", action="store_true")
-        parser.add_argument("--sortish_sampler", action="store_true", default=False)
+        parser.add_argument(
+            "--sortish_sampler",
+            action="store_true",
+            default=False,
+            help="Bucket train examples by source length: shuffled chunks of 50 * batch_size examples are sorted by "
+            "length before being split into batches, which reduces padding.",
+        )
+        parser.add_argument(
+            "--no_cache",
+            action="store_true",
+            default=False,
+            help="Tokenize every batch on the fly instead of caching the tokenized dataset",
+        )
+        parser.add_argument(
+            "--tokenized_cache_dir",
+            type=str,
+            default=None,
+            help="Where to cache the tokenized dataset. Defaults to output_dir/tokenized_cache, point runs that share "
+            "a dataset to the same directory to tokenize it once.",
+        )
         parser.add_argument("--overwrite_output_dir", action="store_true", default=False)
         parser.add_argument("--max_tokens_per_batch", type=int, default=None)
+        parser.add_argument(
+            "--dataloader_prefetch_factor",
+            type=int,
+            default=4,
+            help="Number of batches each DataLoader worker loads in advance. Ignored if --num_workers is 0 or torch<1.7.",
+        )
         parser.add_argument("--logger_name", type=str, choices=["default", "wandb", "wandb_shared"], default="default")
         parser.add_argument("--n_train", type=int, default=-1, required=False, help="# examples. -1 means use all.")
         parser.add_argument("--n_val", type=int, default=500, required=False, help="# examples. -1 means use all.")
@@ -346,6 +431,19 @@ class SummarizationModule(BaseTransformer):
             "--val_metric", type=str, default=None, required=False, choices=["bleu", "rouge2", "loss", None]
         )
         parser.add_argument("--eval_max_gen_length", type=int, default=None, help="never generate more than n tokens")
+        parser.add_argument(
+            "--jit_encoder",
+            action="store_true",
+            default=False,
+            help="Run the encoder through torch.jit.trace when generating during validation and test. Not "
+            "supported with --fp16.",
+        )
+        parser.add_argument(
+            "--val_compute_loss",
+            action="store_true",
+            default=False,
+            help="Also compute and log the training losses during validation and test. Always on with --val_metric loss.",
+        )
         parser.add_argument("--save_top_k", type=int, default=1, required=False, help="How many checkpoints to save")
         parser.add_argument(
             "--early_stopping_patience",
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from contextlib import ExitStack
+
+import fire
+import numpy as np
+import torch
+from packaging import version
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, T5ForConditionalGeneration
+from transformers.models.bart.modeling_bart import shift_tokens_right
+from utils import PrecomputedTeacherDataset, Seq2SeqDataset, save_json, use_task_specific_params
+
+
+_native_amp_available = version.parse(torch.__version__) >= version.parse("1.6")
+
+
+def precompute_teacher_logits(
+    teacher,
+    data_dir,
+    save_dir=None,
+    type_path="train",
+    max_source_length=1024,
+    max_target_length=56,
+    k=256,
+    bs=32,
+    num_workers=4,
+    task="summarization",
+    fp16=False,
+    device="cuda",
+    **kwargs,
+):
+    """Save the teacher's top-k logits for every target token, for distillation.py --precomputed_teacher.
+
+    Run once per split with the same max lengths (and src_lang/tgt_lang kwargs) that will be used for distillation.
+    The source length and prefix are saved next to the logits and checked by PrecomputedTeacherDataset.
+    """
+    save_dir = data_dir if save_dir is None else save_dir
+    tokenizer = AutoTokenizer.from_pretrained(teacher)
+    model = AutoModelForSeq2SeqLM.from_pretrained(teacher).to(device).eval()
+    use_task_specific_params(model, task)  # the student copies the teacher's prefix, so the inputs match training
+    use_autocast = fp16 and _native_amp_available
+    if fp16 and not use_autocast:
+        model = model.half()  # torch.cuda.amp needs torch>=1.6
+    ds = Seq2SeqDataset(
+        tokenizer,
+        data_dir,
+        max_source_length,
+        max_target_length,
+        type_path=type_path,
+        prefix=model.config.prefix,
+        **kwargs,
+    )
+    values_path, indices_path = PrecomputedTeacherDataset.paths(save_dir, type_path)
+    shape = (len(ds), max_target_length, k)
+    topk_values = np.lib.format.open_memmap(values_path, mode="w+", dtype=np.float16, shape=shape)
+    topk_indices = np.lib.format.open_memmap(indices_path, mode="w+", dtype=np.int32, shape=shape)
+    pad = tokenizer.pad_token_id
+
+    dl = DataLoader(ds, batch_size=bs, num_workers=num_workers, shuffle=False, collate_fn=ds.collate_fn)
+    for batch in tqdm(dl, desc=str(values_path)):
+        ids = batch.pop("ids").numpy()
+        batch = {key: v.to(device) for key, v in batch.items()}
+        labels = batch["labels"]
+        if isinstance(model, T5ForConditionalGeneration):
+            decoder_input_ids = model._shift_right(labels)
+        else:
+            decoder_input_ids = shift_tokens_right(labels, pad)
+        with torch.no_grad(), ExitStack() as stack:
+            if use_autocast:
+                stack.enter_context(torch.cuda.amp.autocast())
+            logits = model(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                decoder_input_ids=decoder_input_ids,
+                use_cache=False,
+            )["logits"]
+        values, indices = logits.float().topk(k, dim=-1)
+        tgt_len = labels.shape[1]
+        topk_values[ids, :tgt_len] = values.cpu().numpy()
+        topk_indices[ids, :tgt_len] = indices.cpu().numpy()
+    topk_values.flush()
+    topk_indices.flush()
+    settings = dict(max_source_length=max_source_length, prefix=ds.prefix)
+    save_json(settings, PrecomputedTeacherDataset.settings_path(save_dir, type_path))
+
+
+if __name__ == "__main__":
+    fire.Fire(precompute_teacher_logits)
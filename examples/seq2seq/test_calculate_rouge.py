@@ -56,6 +56,12 @@ def test_single_sent_scores_dont_depend_on_newline_sep():
     assert calculate_rouge(pred, tgt, newline_sep=True) == calculate_rouge(pred, tgt, newline_sep=False)
 
 
+def test_multiprocess_scores_match_single_process():
+    single_process = calculate_rouge(PRED, TGT, bootstrap_aggregation=False)
+    multi_process = calculate_rouge(PRED, TGT, bootstrap_aggregation=False, num_workers=2)
+    assert multi_process == single_process
+
+
 def test_pegasus_newline():
 
     pred = [
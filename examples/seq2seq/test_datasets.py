@@ -1,3 +1,4 @@
+import linecache
 import os
 from pathlib import Path
 
@@ -12,7 +13,15 @@ from test_seq2seq_examples import ARTICLES, BART_TINY, MARIAN_TINY, MBART_TINY,
 from transformers import AutoTokenizer
 from transformers.models.bart.modeling_bart import shift_tokens_right
 from transformers.testing_utils import TestCasePlus, require_torch_non_multi_gpu_but_fix_me, slow
-from utils import FAIRSEQ_AVAILABLE, DistributedSortishSampler, LegacySeq2SeqDataset, Seq2SeqDataset
+from utils import (
+    FAIRSEQ_AVAILABLE,
+    CachedSeq2SeqDataset,
+    DistributedSortishSampler,
+    LegacySeq2SeqDataset,
+    PrecomputedTeacherDataset,
+    Seq2SeqDataset,
+    save_json,
+)
 
 
 BERT_BASE_CASED = "bert-base-cased"
@@ -95,6 +104,68 @@ class TestAll(TestCasePlus):
             assert max_len_target > trunc_target  # Truncated
             break  # No need to test every batch
 
+    @parameterized.expand([BART_TINY, MARIAN_TINY])
+    @require_torch_non_multi_gpu_but_fix_me
+    def test_cached_dataset_matches_seq2seq_dataset(self, tok_name):
+        tokenizer = AutoTokenizer.from_pretrained(tok_name)
+        tmp_dir = make_test_data_dir(tmp_dir=self.get_auto_remove_tmp_dir())
+        kwargs = dict(data_dir=tmp_dir, type_path="train", max_source_length=4, max_target_length=8)
+        cache_dir = Path(self.get_auto_remove_tmp_dir()).joinpath("tokenized_cache")
+        cached_dataset = CachedSeq2SeqDataset(tokenizer, cache_dir=cache_dir, **kwargs)
+        cache_files = {p.name: p.stat().st_mtime for p in cache_dir.iterdir()}
+        assert len(cache_files) == 4
+        assert not Path(tmp_dir).joinpath("tokenized_cache").exists()  # nothing is written to data_dir
+        # loads the memory-mapped cache
+        reloaded_dataset = CachedSeq2SeqDataset(tokenizer, cache_dir=cache_dir, **kwargs)
+        assert {p.name: p.stat().st_mtime for p in cache_dir.iterdir()} == cache_files
+        dataset = Seq2SeqDataset(tokenizer, **kwargs)
+
+        expected = dataset.collate_fn([dataset[i] for i in range(len(dataset))])
+        for ds in [cached_dataset, reloaded_dataset]:
+            batch = ds.collate_fn([ds[i] for i in range(len(ds))])
+            for k in ["input_ids", "attention_mask", "labels", "ids"]:
+                assert batch[k].tolist() == expected[k].tolist(), k
+            assert ds.src_lens == expected["attention_mask"].sum(1).tolist()  # samplers bucket by token length
+
+        # editing the data without changing the number of lines invalidates the cache
+        tgt_file = Path(tmp_dir).joinpath("train.target")
+        tgt_file.write_text("\n".join(line[::-1] for line in tgt_file.read_text().splitlines()))
+        linecache.checkcache(str(tgt_file))  # Seq2SeqDataset reads lines through linecache
+        edited_dataset = CachedSeq2SeqDataset(tokenizer, cache_dir=cache_dir, **kwargs)
+        assert len(list(cache_dir.iterdir())) == 8
+        expected = dataset.collate_fn([dataset[i] for i in range(len(dataset))])
+        assert expected["labels"].tolist() != batch["labels"].tolist()
+        batch = edited_dataset.collate_fn([edited_dataset[i] for i in range(len(edited_dataset))])
+        assert batch["labels"].tolist() == expected["labels"].tolist()
+
+    @require_torch_non_multi_gpu_but_fix_me
+    def test_precomputed_teacher_dataset_looks_up_by_id(self):
+        tokenizer = AutoTokenizer.from_pretrained(BART_TINY)
+        tmp_dir = make_test_data_dir(tmp_dir=self.get_auto_remove_tmp_dir())
+        dataset = Seq2SeqDataset(
+            tokenizer, data_dir=tmp_dir, type_path="train", max_source_length=4, max_target_length=8
+        )
+        n, k = len(dataset), 3
+        values_path, indices_path = PrecomputedTeacherDataset.paths(tmp_dir, "train")
+        values = np.arange(n * 8 * k, dtype=np.float16).reshape(n, 8, k)
+        np.save(values_path, values)
+        np.save(indices_path, values.astype(np.int32))
+        settings_path = PrecomputedTeacherDataset.settings_path(tmp_dir, "train")
+        save_json(dict(max_source_length=4, prefix=""), settings_path)
+        teacher_dataset = PrecomputedTeacherDataset(dataset, tmp_dir)
+        assert len(teacher_dataset) == n
+
+        batch = teacher_dataset.collate_fn([teacher_dataset[i] for i in reversed(range(n))])
+        tgt_len = batch["labels"].shape[1]
+        ids = batch["ids"].tolist()
+        assert batch["teacher_topk_values"].tolist() == values[ids, :tgt_len].tolist()
+        assert batch["teacher_topk_indices"].tolist() == values[ids, :tgt_len].astype(np.int64).tolist()
+
+        # logits saved for other source truncation are rejected instead of silently misaligned
+        save_json(dict(max_source_length=12, prefix=""), settings_path)
+        with pytest.raises(AssertionError, match="max_source_length"):
+            PrecomputedTeacherDataset(dataset, tmp_dir)
+
     @require_torch_non_multi_gpu_but_fix_me
     def test_pack_dataset(self):
         tokenizer = AutoTokenizer.from_pretrained("facebook/mbart-large-cc25")
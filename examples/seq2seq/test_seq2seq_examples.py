@@ -1,8 +1,11 @@
 import argparse
+import json
 import logging
+import math
 import os
 import sys
 import tempfile
+import unittest
 from pathlib import Path
 from unittest.mock import patch
 
@@ -12,15 +15,23 @@ import torch
 
 import lightning_base
 from convert_pl_checkpoint_to_hf import convert_pl_to_hf
-from distillation import distill_main
+from distillation import CUDAGraphTeacher, SummarizationDistiller, distill_main
 from finetune import SummarizationModule, main
 from parameterized import parameterized
+from precompute_teacher_logits import precompute_teacher_logits
 from run_eval import generate_summaries_or_translations, run_generate
 from run_eval_search import run_search
 from transformers import AutoConfig, AutoModelForSeq2SeqLM
 from transformers.hf_api import HfApi
-from transformers.testing_utils import CaptureStderr, CaptureStdout, TestCasePlus, require_torch_gpu, slow
-from utils import ROUGE_KEYS, label_smoothed_nll_loss, lmap, load_json
+from transformers.testing_utils import (
+    CaptureStderr,
+    CaptureStdout,
+    TestCasePlus,
+    require_torch_gpu,
+    require_torch_multi_gpu,
+    slow,
+)
+from utils import ROUGE_KEYS, TracedEncoder, label_smoothed_nll_loss, lmap, load_json
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -31,8 +42,13 @@ CHEAP_ARGS = {
     "max_tokens_per_batch": None,
     "supervise_forward": True,
     "normalize_hidden": True,
+    "cuda_graph_teacher": False,
+    "precomputed_teacher": None,
+    "teacher_device": None,
+    "val_compute_loss": False,
     "label_smoothing": 0.2,
     "eval_max_gen_length": None,
+    "jit_encoder": False,
     "eval_beams": 1,
     "val_metric": "loss",
     "save_top_k": 1,
@@ -43,6 +59,7 @@ CHEAP_ARGS = {
     "cache_dir": "",
     "task": "summarization",
     "num_workers": 2,
+    "dataloader_prefetch_factor": 2,
     "alpha_hid": 0,
     "freeze_embeds": True,
     "enc_only": False,
@@ -82,6 +99,7 @@ CHEAP_ARGS = {
     "test_max_target_length": 12,
     "fast_dev_run": False,
     "no_cache": False,
+    "tokenized_cache_dir": None,
     "n_train": -1,
     "n_val": -1,
     "n_test": -1,
@@ -149,6 +167,45 @@ class TestSummarizationDistiller(TestCasePlus):
         updates = dict(student_encoder_layers=2, student_decoder_layers=1, no_teacher=True)
         self._test_distiller_cli(updates)
 
+    @parameterized.expand([(0.0,), (2.0,)])
+    @require_torch_multi_gpu
+    def test_distill_teacher_on_other_device(self, alpha_hid):
+        updates = dict(
+            student_encoder_layers=1,
+            student_decoder_layers=1,
+            alpha_hid=alpha_hid,  # > 0 also copies the teacher's hidden states back to the student's device
+            teacher_device="cuda:1",
+            gpus=1,
+        )
+        model = self._test_distiller_cli(updates)
+        assert model.teacher.device == torch.device("cuda:1")  # not moved back to cuda:0 by lightning
+        # the teacher's cross attention backpropagates into the student encoder across devices
+        for name, param in model.model.get_encoder().named_parameters():
+            assert param.device == torch.device("cuda:0") and torch.isfinite(param).all(), name
+        last_step_stats = load_json(model.metrics_save_path)["val"][-1]
+        loss_names = ["loss", "ce_loss"] + (["hid_loss_dec"] if alpha_hid else [])
+        for k in loss_names:
+            assert math.isfinite(last_step_stats[f"val_avg_{k}"]), k
+
+    def test_distiller_keeps_teacher_in_eval_mode(self):
+        args_d: dict = CHEAP_ARGS.copy()
+        args_d.update(
+            data_dir=make_test_data_dir(tmp_dir=self.get_auto_remove_tmp_dir()),
+            output_dir=self.get_auto_remove_tmp_dir(),
+            model_name_or_path="sshleifer/tinier_bart",
+            teacher=CHEAP_ARGS["model_name_or_path"],
+            alpha_mlm=0.2,
+            alpha_ce=0.8,
+        )
+        model = SummarizationDistiller(argparse.Namespace(**args_d))
+        model.train()  # lightning calls this at the start of every epoch
+        assert model.model.training
+        assert not model.teacher.training
+        assert not any(m.training for m in model.teacher.modules())
+        model.eval()
+        model.train()
+        assert not model.teacher.training
+
     def test_distill_checkpointing_with_teacher(self):
         updates = dict(
             student_encoder_layers=2,
@@ -237,6 +294,61 @@ class TestSummarizationDistiller(TestCasePlus):
         )
         self._test_distiller_cli(updates)
 
+    @require_torch_gpu
+    @unittest.skipUnless(hasattr(torch.cuda, "graph"), "CUDA graphs require PyTorch>=1.10")
+    def test_cuda_graph_teacher_matches_eager_teacher(self):
+        teacher = AutoModelForSeq2SeqLM.from_pretrained(BART_TINY).cuda().eval()
+        pad, vocab_size = teacher.config.pad_token_id, teacher.config.vocab_size
+        graphs = CUDAGraphTeacher(teacher, pad, 64, 32, src_multiple=16, tgt_multiple=8, max_graphs=2, min_count=1)
+
+        def check(bs, src_len, tgt_len):
+            input_ids = torch.randint(3, vocab_size, (bs, src_len), device="cuda")
+            attention_mask = torch.ones_like(input_ids)
+            input_ids[0, -2:], attention_mask[0, -2:] = pad, 0
+            decoder_input_ids = torch.randint(3, vocab_size, (bs, tgt_len), device="cuda")
+            decoder_input_ids[0, -2:] = pad
+            with torch.no_grad():
+                encoder_hidden_states = teacher.get_encoder()(input_ids, attention_mask=attention_mask)[0]
+                expected = teacher(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    encoder_outputs=(encoder_hidden_states,),
+                    decoder_input_ids=decoder_input_ids,
+                    use_cache=False,
+                ).logits
+                logits = graphs(attention_mask, encoder_hidden_states, decoder_input_ids, False)["logits"]
+            assert logits.shape == expected.shape
+            assert torch.allclose(logits, expected, atol=1e-4)
+
+        check(3, 13, 7)  # captures the (4, 16, 8) bucket
+        check(4, 16, 8)  # replays it
+        assert len(graphs.graphs) == 1
+        check(2, 20, 9)  # captures the (2, 32, 16) bucket
+        assert len(graphs.graphs) == 2
+        check(1, 40, 20)  # max_graphs is reached, so this bucket runs eagerly
+        assert len(graphs.graphs) == 2
+
+    def test_distill_precomputed_teacher(self):
+        data_dir = make_test_data_dir(tmp_dir=self.get_auto_remove_tmp_dir())
+        teacher_dir = self.get_auto_remove_tmp_dir()
+        for split in ["train", "val"]:
+            precompute_teacher_logits(
+                BART_TINY,
+                data_dir,
+                save_dir=teacher_dir,
+                type_path=split,
+                max_source_length=CHEAP_ARGS["max_source_length"],
+                max_target_length=CHEAP_ARGS["max_target_length"],
+                k=8,
+                bs=2,
+                device="cpu",
+            )
+        updates = dict(student_encoder_layers=2, student_decoder_layers=1, precomputed_teacher=teacher_dir)
+        model = self._test_distiller_cli(updates)
+        assert model.teacher is None
+        ce_loss = load_json(model.metrics_save_path)["val"][-1]["val_avg_ce_loss"]
+        assert math.isfinite(ce_loss) and ce_loss != 0
+
     def _test_distiller_cli(self, updates, check_contents=True):
         default_updates = dict(
             label_smoothing=0.0,
@@ -529,3 +641,71 @@ class TestTheRest(TestCasePlus):
         assert (
             getattr(model.hparams, "lr_scheduler") == supported_param
         ), f"lr_scheduler={supported_param} shouldn't fail"
+
+    def test_traced_encoder_matches_eager_encoder(self):
+        model = AutoModelForSeq2SeqLM.from_pretrained(BART_TINY).eval()
+        encoder = model.get_encoder()
+        vocab_size = model.config.vocab_size
+        with torch.no_grad():
+            traced = TracedEncoder(encoder, torch.randint(3, vocab_size, (2, 5)), torch.ones(2, 5, dtype=torch.long))
+            # a different batch size and length than the traced one, with padding
+            input_ids = torch.randint(3, vocab_size, (3, 9))
+            attention_mask = torch.ones_like(input_ids)
+            attention_mask[1, 6:] = 0
+            input_ids[1, 6:] = model.config.pad_token_id
+            expected = encoder(input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+            result = traced(input_ids, attention_mask=attention_mask).last_hidden_state
+        assert result.shape == expected.shape
+        assert torch.allclose(result, expected, atol=1e-5)
+
+    def test_finetune_jit_encoder(self):
+        args_d: dict = CHEAP_ARGS.copy()
+        tmp_dir = make_test_data_dir(tmp_dir=self.get_auto_remove_tmp_dir())
+        output_dir = self.get_auto_remove_tmp_dir()
+        args_d.update(
+            data_dir=tmp_dir,
+            model_name_or_path=BART_TINY,
+            tokenizer_name=None,
+            output_dir=output_dir,
+            do_predict=True,
+            jit_encoder=True,
+        )
+        module = main(argparse.Namespace(**args_d))
+
+        assert len(module.traced_encoders) == 1  # traced once and reused by every _generative_step
+        assert not isinstance(module.model.model.encoder, TracedEncoder)  # the eager encoder is restored
+        metrics = load_json(module.metrics_save_path)
+        assert len(metrics["test"]) == 1
+        assert metrics["test"][0]["test_avg_gen_len"] > 0
+        assert Path(output_dir).joinpath("test_generations.txt").exists()
+
+        args_d.update(output_dir=self.get_auto_remove_tmp_dir(), fp16=True)
+        with pytest.raises(ValueError, match="--jit_encoder can't be combined with --fp16"):
+            SummarizationModule(argparse.Namespace(**args_d))
+
+    def test_finetune_generative_val_metric_skips_losses(self):
+        args_d: dict = CHEAP_ARGS.copy()
+        tmp_dir = make_test_data_dir(tmp_dir=self.get_auto_remove_tmp_dir())
+        output_dir = self.get_auto_remove_tmp_dir()
+        args_d.update(
+            data_dir=tmp_dir,
+            model_name_or_path=BART_TINY,
+            tokenizer_name=None,
+            output_dir=output_dir,
+            do_predict=True,
+            val_metric="rouge2",
+        )
+        module = main(argparse.Namespace(**args_d))
+
+        def reject_constant(name):
+            raise ValueError(f"{name} is not valid JSON")
+
+        # strict parsers such as JSON.parse reject the NaN and Infinity tokens that json.dump writes by default
+        metrics = json.loads(Path(module.metrics_save_path).read_text(), parse_constant=reject_constant)
+        for prefix in ["val", "test"]:
+            assert len(metrics[prefix]) > 0
+            for step_metrics in metrics[prefix]:
+                for k in ROUGE_KEYS + ["gen_time", "gen_len"]:
+                    assert isinstance(step_metrics[f"{prefix}_avg_{k}"], float), k
+                for k in module.loss_names:
+                    assert f"{prefix}_avg_{k}" not in step_metrics, "losses are only logged with --val_compute_loss"
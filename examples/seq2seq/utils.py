@@ -1,3 +1,4 @@
+import hashlib
 import itertools
 import json
 import linecache
@@ -5,6 +6,8 @@ import math
 import os
 import pickle
 import socket
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from logging import getLogger
 from pathlib import Path
 from typing import Callable, Dict, Iterable, List, Tuple, Union
@@ -16,11 +19,13 @@ import torch.distributed as dist
 from rouge_score import rouge_scorer, scoring
 from sacrebleu import corpus_bleu
 from torch import nn
-from torch.utils.data import Dataset, Sampler
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 from sentence_splitter import add_newline_to_end_of_each_sentence
 from transformers import BartTokenizer, EvalPrediction, PreTrainedTokenizer, T5Tokenizer
-from transformers.file_utils import cached_property
+from transformers.file_utils import TRANSFORMERS_CACHE, cached_property
+from transformers.modeling_outputs import BaseModelOutput
 from transformers.models.bart.modeling_bart import shift_tokens_right
 
 
@@ -260,6 +265,185 @@ class Seq2SeqDataset(AbstractSeq2SeqDataset):
         return batch_encoding
 
 
+class CachedSeq2SeqDataset(AbstractSeq2SeqDataset):
+    """Tokenizes the split once and memory-maps the result on later runs, so workers only slice arrays.
+
+    Token ids are stored as fixed-shape int32 arrays under ``cache_dir`` (by default in the transformers cache), along
+    with the true length of each example, which the sortish and dynamic samplers use to bucket examples. The cache is
+    keyed on the data files (path, size and modification time), the tokenizer vocab and every setting that changes
+    the tokenization, so it is rebuilt whenever one of them changes.
+    """
+
+    cache_names = ["source_ids", "target_ids", "source_lens", "target_lens"]
+    chunk_size = 1024  # lines tokenized at a time while building the cache
+
+    def __init__(
+        self, tokenizer, data_dir, max_source_length, max_target_length, type_path="train", cache_dir=None, **kwargs
+    ):
+        super().__init__(tokenizer, data_dir, max_source_length, max_target_length, type_path=type_path, **kwargs)
+        assert self.tokenizer.padding_side == "right", "CachedSeq2SeqDataset assumes right padding"
+        cache_dir = Path(TRANSFORMERS_CACHE).joinpath("seq2seq_tokenized") if cache_dir is None else Path(cache_dir)
+        cache_prefix = cache_dir.joinpath(f"{type_path}_{self.cache_key()}")
+        paths = {name: Path(f"{cache_prefix}.{name}.npy") for name in self.cache_names}
+        if not all(p.exists() for p in paths.values()):
+            self.build_cache(paths)
+        self.source_ids, self.target_ids, self.source_lens, self.target_lens = [
+            np.load(paths[name], mmap_mode="r") for name in self.cache_names
+        ]
+        # sort by the truncated token lengths instead of character counts or train.len when bucketing batches
+        self.src_lens = self.source_lens.tolist()
+        self.used_char_len = False
+
+    def cache_key(self) -> str:
+        data_files = [
+            (str(p.resolve()), p.stat().st_size, p.stat().st_mtime_ns) for p in [self.src_file, self.tgt_file]
+        ]
+        settings = [
+            data_files,
+            self.tokenizer.__class__.__name__,
+            sorted(self.tokenizer.get_vocab().items()),
+            self.max_source_length,
+            self.max_target_length,
+            self.prefix,
+            len(self),
+            sorted(self.dataset_kwargs.items()),
+        ]
+        return hashlib.md5(json.dumps(settings).encode()).hexdigest()
+
+    def tokenize(self, src_texts: List[str], tgt_texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns source ids, source attention mask and target ids, all padded to their max length."""
+        if hasattr(self.tokenizer, "prepare_seq2seq_batch"):
+            batch_encoding = self.tokenizer.prepare_seq2seq_batch(
+                src_texts,
+                tgt_texts=tgt_texts,
+                max_length=self.max_source_length,
+                max_target_length=self.max_target_length,
+                padding="max_length",
+                return_tensors="np",
+                **self.dataset_kwargs,
+            )
+            return batch_encoding["input_ids"], batch_encoding["attention_mask"], batch_encoding["labels"]
+        tokenizer_kwargs = dict(padding="max_length", truncation=True, return_tensors="np", **self.dataset_kwargs)
+        source = self.tokenizer(src_texts, max_length=self.max_source_length, **tokenizer_kwargs)
+        target = self.tokenizer(tgt_texts, max_length=self.max_target_length, **tokenizer_kwargs)
+        return source["input_ids"], source["attention_mask"], target["input_ids"]
+
+    def build_cache(self, paths: Dict[str, Path]) -> None:
+        n_obs = len(self)
+        with self.src_file.open() as f:
+            src_lines = [self.prefix + x.rstrip("\n") for x in itertools.islice(f, n_obs)]
+        with self.tgt_file.open() as f:
+            tgt_lines = [x.rstrip("\n") for x in itertools.islice(f, n_obs)]
+        assert len(src_lines) == len(tgt_lines) == n_obs, f"{self.src_file} and {self.tgt_file} have different lengths"
+
+        # write to temporary files first so that a concurrent or interrupted build never leaves a partial cache
+        tmp_paths = {name: p.with_suffix(f".tmp{os.getpid()}.npy") for name, p in paths.items()}
+        tmp_paths["source_ids"].parent.mkdir(parents=True, exist_ok=True)
+        source_ids = np.lib.format.open_memmap(
+            tmp_paths["source_ids"], mode="w+", dtype=np.int32, shape=(n_obs, self.max_source_length)
+        )
+        target_ids = np.lib.format.open_memmap(
+            tmp_paths["target_ids"], mode="w+", dtype=np.int32, shape=(n_obs, self.max_target_length)
+        )
+        source_lens = np.zeros(n_obs, dtype=np.int32)
+        target_lens = np.zeros(n_obs, dtype=np.int32)
+        for start in range(0, n_obs, self.chunk_size):
+            end = min(start + self.chunk_size, n_obs)
+            src_ids, src_mask, tgt_ids = self.tokenize(src_lines[start:end], tgt_lines[start:end])
+            source_ids[start:end] = src_ids
+            target_ids[start:end] = tgt_ids
+            source_lens[start:end] = src_mask.sum(axis=1)
+            target_lens[start:end] = (tgt_ids != self.pad_token_id).sum(axis=1)
+        assert source_lens.min() > 0 and target_lens.min() > 0, f"found empty example in {self.src_file}"
+        source_ids.flush()
+        target_ids.flush()
+        del source_ids, target_ids
+        np.save(tmp_paths["source_lens"], source_lens)
+        np.save(tmp_paths["target_lens"], target_lens)
+        for name, path in paths.items():
+            os.replace(tmp_paths[name], path)
+
+    def __getitem__(self, index) -> Dict[str, torch.Tensor]:
+        src_len, tgt_len = self.source_lens[index], self.target_lens[index]
+        return {
+            "input_ids": torch.from_numpy(self.source_ids[index, :src_len].astype(np.int64)),
+            "labels": torch.from_numpy(self.target_ids[index, :tgt_len].astype(np.int64)),
+            "id": index,
+        }
+
+    def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
+        """Pad to the longest example in the batch."""
+        src_lens = torch.tensor([len(x["input_ids"]) for x in batch])
+        input_ids = pad_sequence([x["input_ids"] for x in batch], batch_first=True, padding_value=self.pad_token_id)
+        labels = pad_sequence([x["labels"] for x in batch], batch_first=True, padding_value=self.pad_token_id)
+        attention_mask = (torch.arange(input_ids.shape[1])[None, :] < src_lens[:, None]).long()
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+            "ids": torch.tensor([x["id"] for x in batch]),
+        }
+
+
+class PrecomputedTeacherDataset(Dataset):
+    """Adds the teacher's top-k logits, saved by precompute_teacher_logits.py, to the batches of a seq2seq dataset.
+
+    The logits are memory-mapped and looked up by example id inside ``collate_fn``, so the lookup happens in the
+    dataloader workers. Samplers are delegated to the wrapped dataset.
+    """
+
+    def __init__(self, dataset: AbstractSeq2SeqDataset, teacher_dir, type_path="train"):
+        super().__init__()
+        self.dataset = dataset
+        values_path, indices_path = self.paths(teacher_dir, type_path)
+        self.topk_values = np.load(values_path, mmap_mode="r")
+        self.topk_indices = np.load(indices_path, mmap_mode="r")
+        n_saved, saved_target_length, _ = self.topk_values.shape
+        assert n_saved >= len(dataset), f"{values_path} has {n_saved} examples, expected at least {len(dataset)}"
+        assert (
+            saved_target_length >= dataset.max_target_length
+        ), f"{values_path} was saved with max_target_length={saved_target_length} < {dataset.max_target_length}"
+        # the teacher saw truncated sources, any other truncation or prefix would misalign its targets
+        saved_source_settings = load_json(self.settings_path(teacher_dir, type_path))
+        source_settings = dict(max_source_length=dataset.max_source_length, prefix=dataset.prefix)
+        assert saved_source_settings == source_settings, f"{values_path} was saved with {saved_source_settings}"
+
+    @staticmethod
+    def paths(teacher_dir, type_path) -> Tuple[Path, Path]:
+        prefix = Path(teacher_dir).joinpath(type_path)
+        return Path(f"{prefix}.teacher_topk_values.npy"), Path(f"{prefix}.teacher_topk_indices.npy")
+
+    @staticmethod
+    def settings_path(teacher_dir, type_path) -> Path:
+        """Source side settings of the run that saved the logits, the target length is the arrays' second dim."""
+        return Path(teacher_dir).joinpath(f"{type_path}.teacher_topk_settings.json")
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+    @property
+    def src_lens(self):
+        return self.dataset.src_lens
+
+    def make_sortish_sampler(self, *args, **kwargs):
+        return self.dataset.make_sortish_sampler(*args, **kwargs)
+
+    def make_dynamic_sampler(self, *args, **kwargs):
+        return self.dataset.make_dynamic_sampler(*args, **kwargs)
+
+    def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
+        batch_encoding = self.dataset.collate_fn(batch)
+        assert "ids" in batch_encoding, f"{self.dataset.__class__.__name__} batches don't have example ids"
+        ids = batch_encoding["ids"].numpy()
+        tgt_len = batch_encoding["labels"].shape[1]
+        batch_encoding["teacher_topk_values"] = torch.from_numpy(self.topk_values[ids, :tgt_len])
+        batch_encoding["teacher_topk_indices"] = torch.from_numpy(self.topk_indices[ids, :tgt_len].astype(np.int64))
+        return batch_encoding
+
+
 class Seq2SeqDataCollator:
     def __init__(self, tokenizer, data_args, tpu_num_cores=None):
         self.tokenizer = tokenizer
@@ -411,6 +595,48 @@ class DistributedSortishSampler(Sampler):
         self.epoch = epoch
 
 
+class CUDAPrefetcher:
+    """Wraps a DataLoader and copies the next batch to the GPU on a side stream while the current one is used.
+
+    Adapted from apex's ``data_prefetcher``. The DataLoader should use ``pin_memory=True``, otherwise the copies
+    are synchronous and nothing is overlapped.
+    """
+
+    def __init__(self, loader: DataLoader):
+        self.loader = loader
+        self.dataset = loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    @staticmethod
+    def _to_device(batch: Dict, device: torch.device) -> Dict:
+        return {k: v.to(device, non_blocking=True) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+
+    def __iter__(self):
+        device = torch.device("cuda", torch.cuda.current_device())
+        stream = torch.cuda.Stream(device=device)
+        loader_iter = iter(self.loader)
+
+        def preload():
+            batch = next(loader_iter, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(batch, device)
+
+        next_batch = preload()
+        while next_batch is not None:
+            compute_stream = torch.cuda.current_stream(device)
+            compute_stream.wait_stream(stream)
+            batch = next_batch
+            for v in batch.values():
+                if isinstance(v, torch.Tensor):
+                    v.record_stream(compute_stream)  # memory was allocated on the side stream
+            next_batch = preload()
+            yield batch
+
+
 logger = getLogger(__name__)
 
 
@@ -486,6 +712,19 @@ def extract_rouge_mid_statistics(dct):
     return new_dict
 
 
+@lru_cache(maxsize=None)
+def get_rouge_scorer(rouge_keys: Tuple[str, ...], use_stemmer: bool) -> rouge_scorer.RougeScorer:
+    """Build each scorer once per process. RougeScorer.score does not modify the scorer, so it can be shared."""
+    return rouge_scorer.RougeScorer(list(rouge_keys), use_stemmer=use_stemmer)
+
+
+def _score_rouge_chunk(args) -> List[Dict]:
+    """Score a chunk of (pred, tgt) pairs in a worker process of calculate_rouge."""
+    rouge_keys, use_stemmer, pairs = args
+    scorer = get_rouge_scorer(tuple(rouge_keys), use_stemmer)
+    return [scorer.score(pred, tgt) for pred, tgt in pairs]
+
+
 def calculate_rouge(
     pred_lns: List[str],
     tgt_lns: List[str],
@@ -494,6 +733,7 @@ def calculate_rouge(
     return_precision_and_recall=False,
     bootstrap_aggregation=True,
     newline_sep=True,
+    num_workers=1,
 ) -> Dict:
     """Calculate rouge using rouge_scorer package.
 
@@ -508,19 +748,25 @@ def calculate_rouge(
             this function returns a collections.defaultdict[metric: list of values for each observation for each subscore]``
         newline_sep:(default=True) whether to add newline between sentences. This is essential for calculation rougeL
         on multi sentence summaries (CNN/DM dataset).
+        num_workers: (default=1) number of processes to score with. rouge_score is pure python and holds the GIL,
+        so threads would not help. Only worth it for large inputs, e.g. full test sets in rouge_cli.py.
 
     Returns:
          Dict[score: value] if aggregate else defaultdict(list) keyed by rouge_keys
 
     """
-    scorer = rouge_scorer.RougeScorer(rouge_keys, use_stemmer=use_stemmer)
+    pairs = list(zip(tgt_lns, pred_lns))
+    if newline_sep:  # rougeLsum expects "\n" separated sentences within a summary
+        pairs = [(add_newline_to_end_of_each_sentence(p), add_newline_to_end_of_each_sentence(t)) for p, t in pairs]
+    if num_workers > 1 and len(pairs) > num_workers:
+        chunk_size = math.ceil(len(pairs) / num_workers)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            work = [(rouge_keys, use_stemmer, chunk) for chunk in chunks(pairs, chunk_size)]
+            all_scores = flatten_list(executor.map(_score_rouge_chunk, work))
+    else:
+        all_scores = _score_rouge_chunk((rouge_keys, use_stemmer, pairs))
     aggregator = scoring.BootstrapAggregator()
-    for pred, tgt in zip(tgt_lns, pred_lns):
-        # rougeLsum expects "\n" separated sentences within a summary
-        if newline_sep:
-            pred = add_newline_to_end_of_each_sentence(pred)
-            tgt = add_newline_to_end_of_each_sentence(tgt)
-        scores = scorer.score(pred, tgt)
+    for scores in all_scores:  # BootstrapAggregator is not process safe, so results are collected here
         aggregator.add_scores(scores)
 
     if bootstrap_aggregation:
@@ -534,6 +780,36 @@ def calculate_rouge(
         return aggregator._scores  # here we return defaultdict(list)
 
 
+class _EncoderLastHiddenState(nn.Module):
+    """Traceable view of an encoder: positional tensors in, last hidden state out."""
+
+    def __init__(self, encoder: nn.Module):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class TracedEncoder(nn.Module):
+    """A ``torch.jit.trace``d encoder that can be called like the original one, e.g. by ``generate()``.
+
+    Parameters are shared with ``encoder``, so optimizer updates are picked up without re-tracing.
+    Only the last hidden state is returned. Data dependent branches are frozen the way the traced batch took them,
+    e.g. never taking the fp16 overflow clamp of Bart's encoder layers, so don't trace an encoder that runs in fp16.
+    """
+
+    def __init__(self, encoder: nn.Module, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        super().__init__()
+        self.traced = torch.jit.trace(_EncoderLastHiddenState(encoder), (input_ids, attention_mask))
+
+    def forward(
+        self, input_ids, attention_mask=None, output_attentions=False, output_hidden_states=False, return_dict=True
+    ):
+        assert not output_attentions and not output_hidden_states, "TracedEncoder only returns the last hidden state"
+        return BaseModelOutput(last_hidden_state=self.traced(input_ids, attention_mask))
+
+
 # Utilities for freezing parameters and checking whether they are frozen
 
 
@@ -609,10 +885,7 @@ def parse_numeric_n_bool_cl_kwargs(unparsed_args: List[str]) -> Dict[str, Union[
 
 
 def write_txt_file(ordered_tgt, path):
-    f = Path(path).open("w")
-    for ln in ordered_tgt:
-        f.write(ln + "\n")
-        f.flush()
+    Path(path).write_text("".join(ln + "\n" for ln in ordered_tgt))
 
 
 def chunks(lst, n):
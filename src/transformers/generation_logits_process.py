@@ -247,8 +247,11 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
         cur_len = input_ids.shape[-1]
         banned_batch_tokens = self._calc_banned_ngram_tokens(input_ids, num_batch_hypotheses, cur_len)
 
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores[i, banned_tokens] = -float("inf")
+        # ban the tokens of all hypotheses with a single indexing op instead of one per hypothesis
+        banned_rows = [i for i, banned_tokens in enumerate(banned_batch_tokens) for _ in banned_tokens]
+        banned_cols = [token for banned_tokens in banned_batch_tokens for token in banned_tokens]
+        if banned_cols:
+            scores[banned_rows, banned_cols] = -float("inf")
 
         return scores
 
@@ -259,9 +262,11 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
         if cur_len + 1 < self.ngram_size:
             # return no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
             return [[] for _ in range(num_hypos)]
+        # copy the generated tokens to the CPU once, rather than twice per hypothesis
+        prev_input_ids = prev_input_ids.tolist()
         generated_ngrams = [{} for _ in range(num_hypos)]
         for idx in range(num_hypos):
-            gen_tokens = prev_input_ids[idx].tolist()
+            gen_tokens = prev_input_ids[idx]
             generated_ngram = generated_ngrams[idx]
             for ngram in zip(*[gen_tokens[i:] for i in range(self.ngram_size)]):
                 prev_ngram_tuple = tuple(ngram[:-1])
@@ -270,7 +275,7 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
         def _get_generated_ngrams(hypo_idx):
             # Before decoding the next token, prevent decoding of ngrams that have already appeared
             start_idx = cur_len + 1 - self.ngram_size
-            ngram_idx = tuple(prev_input_ids[hypo_idx, start_idx:cur_len].tolist())
+            ngram_idx = tuple(prev_input_ids[hypo_idx][start_idx:cur_len])
             return generated_ngrams[hypo_idx].get(ngram_idx, [])
 
         banned_tokens = [_get_generated_ngrams(hypo_idx) for hypo_idx in range(num_hypos)]
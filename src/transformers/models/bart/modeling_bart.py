@@ -219,7 +219,7 @@ def _make_linear_from_emb(emb):
 
 def shift_tokens_right(input_ids, pad_token_id):
     """Shift input ids one token to the right, and wrap the last non pad token (usually <eos>)."""
-    prev_output_tokens = input_ids.clone()
+    prev_output_tokens = input_ids.new_empty(input_ids.shape)  # every column is written below, no need to clone
     index_of_eos = (input_ids.ne(pad_token_id).sum(dim=1) - 1).unsqueeze(-1)
     prev_output_tokens[:, 0] = input_ids.gather(1, index_of_eos).squeeze()
     prev_output_tokens[:, 1:] = input_ids[:, :-1]
@@ -1083,9 +1083,12 @@ class BartForConditionalGeneration(PretrainedBartModel):
     def _reorder_cache(past, beam_idx):
         reordered_past = []
         for layer_past in past:
-            # get the correct batch idx from decoder layer's batch dim for cross and self-attn
+            # get the correct batch idx from decoder layer's batch dim for self-attn. beam_idx only moves hypotheses
+            # between the beams of the same example, whose cross-attn (encoder_decoder) keys and values are identical
+            # copies of that example's encoder states, so reordering them would be a no-op copy.
             layer_past_new = {
-                attn_key: _reorder_buffer(attn_cache, beam_idx) for attn_key, attn_cache in layer_past.items()
+                attn_key: attn_cache if attn_key == "encoder_decoder" else _reorder_buffer(attn_cache, beam_idx)
+                for attn_key, attn_cache in layer_past.items()
             }
             reordered_past.append(layer_past_new)
         return reordered_past